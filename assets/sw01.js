@@ -6,6 +6,15 @@ const CACHE = "pwabuilder-page";
 
 const offlineFallbackPage = "/assets/offline.html";
 
+// Responses of callbacks carrying an ETag (referee tables) are revalidated against the server.
+// Bump the version on every release, older callback caches are deleted on activate.
+const CALLBACK_CACHE = "dash-callbacks-v2";
+// Every grid block and window count is a separate entry, keep only the newest ones
+const CALLBACK_CACHE_ENTRIES = 100;
+const CALLBACK_CACHE_MAX_AGE = 24 * 60 * 60 * 1000;
+// Outputs of the callbacks that can carry an ETag, other callbacks (downloads) are passed through untouched
+const ETAG_OUTPUTS = ["_pages_content.children", "match-grid"];
+
 self.addEventListener("message", (event) => {
   if (event.data && event.data.type === "SKIP_WAITING") {
     self.skipWaiting();
@@ -19,6 +28,17 @@ self.addEventListener('install', async (event) => {
   );
 });
 
+self.addEventListener('activate', (event) => {
+  event.waitUntil((async () => {
+    const names = await caches.keys();
+    await Promise.all(
+      names.filter((name) => name.startsWith("dash-callbacks-") && name !== CALLBACK_CACHE)
+        .map((name) => caches.delete(name))
+    );
+    await trimCallbackCache(await caches.open(CALLBACK_CACHE), true);
+  })());
+});
+
 if (workbox.navigationPreload.isSupported()) {
   workbox.navigationPreload.enable();
 }
@@ -42,5 +62,86 @@ self.addEventListener('fetch', (event) => {
         return cachedResp;
       }
     })());
+  } else if (event.request.method === 'POST' && new URL(event.request.url).pathname.endsWith('/_dash-update-component')) {
+    event.respondWith(handleCallback(event.request));
+  }
+});
+
+function callbackOutput(body) {
+  try {
+    return JSON.parse(body).output || '';
+  } catch (error) {
+    return '';
+  }
+}
+
+async function handleCallback(request) {
+  // Request.body is not a stream in every browser, read a copy of the body as text
+  const body = await request.clone().text();
+  if (!ETAG_OUTPUTS.some((name) => callbackOutput(body).includes(name))) {
+    return fetch(request);
+  }
+  return revalidateCallback(request, body);
+}
+
+async function revalidateCallback(request, body) {
+  const digest = await crypto.subtle.digest('SHA-256', new TextEncoder().encode(body));
+  const hash = Array.from(new Uint8Array(digest)).map((b) => b.toString(16).padStart(2, '0')).join('');
+  const cacheKey = new Request(new URL('_dash-cache/' + hash, self.registration.scope).href);
+
+  const cache = await caches.open(CALLBACK_CACHE);
+  let cachedResp = await cache.match(cacheKey);
+  if (cachedResp && isExpired(cachedResp)) {
+    await cache.delete(cacheKey);
+    cachedResp = undefined;
+  }
+  const headers = new Headers(request.headers);
+  if (cachedResp && cachedResp.headers.has('ETag')) {
+    headers.set('If-None-Match', cachedResp.headers.get('ETag'));
+  }
+
+  let networkResp;
+  try {
+    networkResp = await fetch(request.url, {method: 'POST', headers, body, credentials: request.credentials});
+  } catch (error) {
+    if (cachedResp) {
+      return cachedResp;
+    }
+    throw error;
+  }
+  if (networkResp.status === 304 && cachedResp) {
+    return cachedResp;
+  }
+  if (networkResp.ok && networkResp.headers.has('ETag')) {
+    await putCallback(cache, cacheKey, networkResp.clone());
+  }
+  return networkResp;
+}
+
+function isExpired(response) {
+  return Date.now() - Number(response.headers.get('X-Cached-At') || 0) > CALLBACK_CACHE_MAX_AGE;
+}
+
+async function putCallback(cache, cacheKey, response) {
+  const headers = new Headers(response.headers);
+  headers.set('X-Cached-At', Date.now().toString());
+  const body = await response.blob();
+  // Cache keys are kept in insertion order, delete first so the entry becomes the newest one
+  await cache.delete(cacheKey);
+  await cache.put(cacheKey, new Response(body, {status: response.status, statusText: response.statusText, headers}));
+  await trimCallbackCache(cache);
+}
+
+async function trimCallbackCache(cache, removeExpired = false) {
+  const keys = await cache.keys();
+  const overflow = Math.max(0, keys.length - CALLBACK_CACHE_ENTRIES);
+  const stale = [];
+  // Expired entries are also dropped on lookup, scanning all of them is only done on activate
+  for (const key of removeExpired ? keys.slice(overflow) : []) {
+    const response = await cache.match(key);
+    if (!response || isExpired(response)) {
+      stale.push(key);
+    }
   }
-});
\ No newline at end of file
+  await Promise.all(keys.slice(0, overflow).concat(stale).map((key) => cache.delete(key)));
+}
\ No newline at end of file
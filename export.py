@@ -0,0 +1,113 @@
+import argparse
+import os.path
+import re
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+
+from src.utils import config, template, pdf_convert, jpg_convert, get_session, search_ref, create_pptx, \
+    convert_pdf, create_jpg
+
+
+def file_name(group):
+    return re.sub(r"[^\w\-]+", "_", group).strip("_")
+
+
+def export_group(group, start, end, output, formats, profile_root):
+    timings = {}
+    timestamp = time.perf_counter()
+    matches = []
+    for ref in config["grouped_users"][group]["users"]:
+        for match in search_ref(get_session(), *ref, start=start, datedelta=(end - start).days):
+            if start <= match.date.date() <= end and match not in matches:
+                matches.append(match)
+    matches.sort(key=lambda x: x.date)
+    timings["fetch"] = time.perf_counter() - timestamp
+
+    name = file_name(group)
+    if len(matches) == 0:
+        return group, 0, timings
+
+    timestamp = time.perf_counter()
+    data = [x.create_powerpoint_output() for x in matches]
+    with tempfile.TemporaryDirectory() as dir_:
+        files = {"pptx": [create_pptx(data, dir_, name=name)]}
+        timings["pptx"] = time.perf_counter() - timestamp
+        if "pdf" in formats or "jpg" in formats:
+            timestamp = time.perf_counter()
+            # LibreOffice profile per worker process, reused for all groups of this worker
+            profile_dir = os.path.join(profile_root, str(os.getpid()))
+            files["pdf"] = [convert_pdf(dir_, name=name, profile_dir=profile_dir)]
+            timings["pdf"] = time.perf_counter() - timestamp
+        if "jpg" in formats:
+            timestamp = time.perf_counter()
+            files["jpg"] = create_jpg(dir_, name=name)
+            timings["jpg"] = time.perf_counter() - timestamp
+        for file_format in formats:
+            for file in files[file_format]:
+                shutil.move(file, os.path.join(output, os.path.basename(file)))
+    return group, len(matches), timings
+
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export matchday graphics of all groups.")
+    parser.add_argument("-o", "--output", default="export", help="Output directory")
+    parser.add_argument("--start", type=parse_date, default=date.today(), help="First day (YYYY-MM-DD)")
+    parser.add_argument("--end", type=parse_date, default=None, help="Last day (YYYY-MM-DD), default start + 7 days")
+    parser.add_argument("-f", "--formats", nargs="+", choices=["pptx", "pdf", "jpg"], default=["pptx", "pdf", "jpg"])
+    parser.add_argument("-g", "--groups", nargs="+", default=list(config["grouped_users"]),
+                        help="Groups to export, default all")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of parallel processes")
+    args = parser.parse_args()
+
+    if not template:
+        parser.error("Template config is not valid, see config.json")
+    if ("pdf" in args.formats or "jpg" in args.formats) and not pdf_convert:
+        parser.error("PDF export requires libreoffice")
+    if "jpg" in args.formats and not jpg_convert:
+        parser.error("JPG export requires pdftoppm (poppler-utils)")
+    file_names = {}
+    for group in args.groups:
+        if group not in config["grouped_users"]:
+            parser.error(f"Unknown group '{group}'")
+        # Groups with the same file name would overwrite each other's files
+        if file_name(group) in file_names:
+            parser.error(f"Groups '{file_names[file_name(group)]}' and '{group}' both export to "
+                         f"'{file_name(group)}', rename one of them")
+        file_names[file_name(group)] = group
+    end = args.end if args.end is not None else args.start + timedelta(days=7)
+    os.makedirs(args.output, exist_ok=True)
+
+    timestamp = time.perf_counter()
+    failed = []
+    # The LibreOffice profiles of the workers are removed once the pool is shut down
+    with tempfile.TemporaryDirectory(prefix="dfbnet-libreoffice-") as profile_root, \
+            ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(export_group, group, args.start, end, args.output, args.formats,
+                                   profile_root): group for group in args.groups}
+        for future in as_completed(futures):
+            try:
+                group, count, timings = future.result()
+            except Exception as e:
+                # One failing group (DFBnet, LibreOffice, ...) must not abort the others
+                failed.append(futures[future])
+                print(f"{futures[future]}: failed ({e!r})")
+                continue
+            details = ", ".join(f"{key} {value:.1f}s" for key, value in timings.items())
+            print(f"{group}: {count} matches ({details})")
+    exported = len(args.groups) - len(failed)
+    print(f"Exported {exported} of {len(args.groups)} groups in {time.perf_counter() - timestamp:.1f}s")
+    if failed:
+        print("Failed groups: " + ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+import os
+
+# Requests mostly wait for DFBnet, so every worker serves several of them in threads.
+# The DFBnet session and match cache in src/utils.py are shared by the threads of a worker.
+# BasicAuth verifies the password of every request in its thread, the hash queue in src/utils.py
+# defaults to one slot per thread. Rate limits (e.g. hash_rate_limit of /hash) are counted per worker.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("GUNICORN_WORKERS", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+# PDF/JPG conversion with LibreOffice can take longer than the default 30s
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
@@ -0,0 +1,207 @@
+import argparse
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlencode
+
+import requests
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def split_output(output):
+    # Multi output callbacks are joined as "..a.children...b.data.."
+    outputs = output.strip(".").split("...") if output.startswith("..") else [output]
+    result = []
+    for el in outputs:
+        component_id, prop = el.rsplit(".", 1)
+        if component_id.startswith("{"):
+            component_id = json.loads(component_id)
+        result.append({"id": component_id, "property": prop.split("@")[0]})
+    return result
+
+
+def find_component(layout, component_id):
+    if isinstance(layout, list):
+        for el in layout:
+            found = find_component(el, component_id)
+            if found is not None:
+                return found
+    elif isinstance(layout, dict):
+        props = layout.get("props", {})
+        if props.get("id") == component_id:
+            return props
+        for value in props.values():
+            found = find_component(value, component_id)
+            if found is not None:
+                return found
+    return None
+
+
+class Client:
+    def __init__(self, url, auth):
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+        self.session.auth = auth
+        dependencies = self.session.get(f"{self.url}/_dash-dependencies").json()
+        self.pages_callback = next(x for x in dependencies if "_pages_content.children" in x["output"])
+        self.grid_callback = next((x for x in dependencies if x["output"].endswith(".getRowsResponse")), None)
+        self.download_callbacks = {}
+        for x in dependencies:
+            if x["output"].startswith("download-instagram-template.data"):
+                self.download_callbacks[json.loads(x["inputs"][0]["id"])["type"]] = x
+
+    def post_callback(self, callback, values, changed, inputs=None, state=None, outputs=None):
+        def fill(dependency):
+            return {"id": dependency["id"], "property": dependency["property"],
+                    "value": values.get(f"{dependency['id']}.{dependency['property']}")}
+
+        if outputs is None:
+            outputs = split_output(callback["output"])
+            if len(outputs) == 1:
+                outputs = outputs[0]
+        payload = {
+            "output": callback["output"],
+            "outputs": outputs,
+            "inputs": inputs if inputs is not None else [fill(x) for x in callback["inputs"]],
+            "state": state if state is not None else [fill(x) for x in callback["state"]],
+            "changedPropIds": changed,
+        }
+        response = self.session.post(f"{self.url}/_dash-update-component", json=payload)
+        response.raise_for_status()
+        return response
+
+    def view_refs(self, refs):
+        search = "?" + urlencode([("refs", ref) for ref in refs])
+        values = {"_pages_location.pathname": "/refs", "_pages_location.search": search}
+        response = self.post_callback(self.pages_callback, values, ["_pages_location.pathname"])
+        return response.json()["response"]
+
+    def has_grid(self, layout):
+        return self.grid_callback is not None and \
+            find_component(layout, {"type": "match-grid", "view": "name"}) is not None
+
+    def layout_values(self, layout, hidden_names=False):
+        values = {"tables-name.hidden": hidden_names}
+        for store in ("download-instagram-data", "grid-refs", "grid-windows"):
+            props = find_component(layout, store)
+            values[f"{store}.data"] = props["data"] if props is not None else None
+        return values
+
+    def grid_rows(self, layout, view, start_row=0, end_row=50):
+        # Single grid mode, the infinite row model requests the rows block-wise
+        grid_id = {"type": "match-grid", "view": view}
+        pattern = json.dumps(grid_id, separators=(",", ":"), sort_keys=True)
+        inputs = [{"id": grid_id, "property": "getRowsRequest", "value": {"startRow": start_row, "endRow": end_row}}]
+        response = self.post_callback(self.grid_callback, self.layout_values(layout), [f"{pattern}.getRowsRequest"],
+                                      inputs=inputs, outputs={"id": grid_id, "property": "getRowsResponse"})
+        return next(iter(response.json()["response"].values()))["getRowsResponse"]["rowData"]
+
+    def download(self, layout, button_type, view=None, row=None):
+        callback = self.download_callbacks.get(button_type)
+        if callback is None:
+            return None
+        values = self.layout_values(layout, hidden_names=view == "date")
+        if view is None:
+            store = values["download-instagram-data.data"]
+            if not store or not store[0]:
+                return None
+            button_id = {"index": random.randrange(len(store[0])), "type": button_type}
+        else:
+            # Single grid mode, the button of the view downloads the group of the selected row
+            button_id = {"index": view, "type": button_type}
+        state = []
+        for dependency in callback["state"]:
+            if dependency["id"].startswith("{"):
+                state.append([{"id": {"type": "match-grid", "view": x}, "property": dependency["property"],
+                               "value": [row] if x == view and row is not None else None}
+                              for x in ("name", "date") if view is not None])
+            else:
+                state.append({"id": dependency["id"], "property": dependency["property"],
+                              "value": values.get(f"{dependency['id']}.{dependency['property']}")})
+        pattern = json.dumps(button_id, separators=(",", ":"), sort_keys=True)
+        inputs = [[{"id": button_id, "property": "n_clicks", "value": 1}]]
+        return self.post_callback(callback, values, [f"{pattern}.n_clicks"], inputs=inputs, state=state)
+
+
+def run_user(client, args, results, lock, stop_at):
+    rng = random.Random()
+
+    def record(operation, timestamp):
+        with lock:
+            results[operation].append(time.perf_counter() - timestamp)
+
+    while time.monotonic() < stop_at:
+        refs = rng.sample(args.refs, min(len(args.refs), rng.randint(1, args.refs_per_view)))
+        try:
+            timestamp = time.perf_counter()
+            response = client.view_refs(refs)
+            record("refs", timestamp)
+            layout = next(iter(response.values()))["children"]
+            view, row = None, None
+            if client.has_grid(layout):
+                view = rng.choice(["name", "date"])
+                timestamp = time.perf_counter()
+                rows = client.grid_rows(layout, view)
+                record("rows", timestamp)
+                if not rows:
+                    continue
+                row = rng.choice(rows)
+            if args.downloads and rng.random() < args.download_ratio:
+                operation = rng.choice(args.downloads)
+                button_type = "download-instagram-button" + ("" if operation == "pptx" else f"-{operation}")
+                timestamp = time.perf_counter()
+                if client.download(layout, button_type, view, row) is not None:
+                    record(operation, timestamp)
+        except (requests.RequestException, ValueError, KeyError, StopIteration) as e:
+            with lock:
+                results["errors"].append(repr(e))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate authenticated users on /refs, the grid rows and the download callbacks.")
+    parser.add_argument("--url", default="http://localhost:8080", help="URL of the app")
+    parser.add_argument("--upstream", default="http://localhost:8081", help="URL of the DFBnet stand-in")
+    parser.add_argument("-u", "--username", required=True)
+    parser.add_argument("-p", "--password", required=True)
+    parser.add_argument("-r", "--refs", nargs="+", required=True, help="Referees as NACHNAME_VORNAME")
+    parser.add_argument("--refs-per-view", type=int, default=3)
+    parser.add_argument("-c", "--users", type=int, default=10, help="Concurrent users")
+    parser.add_argument("-d", "--duration", type=float, default=30, help="Duration in seconds")
+    parser.add_argument("--downloads", nargs="*", choices=["pptx", "pdf", "jpg"], default=["pptx"])
+    parser.add_argument("--download-ratio", type=float, default=0.1)
+    args = parser.parse_args()
+
+    requests.post(f"{args.upstream}/stats/reset").raise_for_status()
+    results = defaultdict(list)
+    lock = threading.Lock()
+    clients = [Client(args.url, (args.username, args.password)) for _ in range(args.users)]
+    timestamp = time.monotonic()
+    stop_at = timestamp + args.duration
+    threads = [threading.Thread(target=run_user, args=(client, args, results, lock, stop_at)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.monotonic() - timestamp
+
+    print(f"{args.users} users, {duration:.1f}s")
+    for operation, values in results.items():
+        if operation == "errors" or not values:
+            continue
+        print(f"{operation}: {len(values)} requests, {len(values) / duration:.2f} req/s, "
+              f"p50 {percentile(values, 50) * 1000:.0f}ms, p95 {percentile(values, 95) * 1000:.0f}ms, "
+              f"p99 {percentile(values, 99) * 1000:.0f}ms")
+    if results["errors"]:
+        print(f"errors: {len(results['errors'])}, e.g. {results['errors'][0]}")
+    upstream = requests.get(f"{args.upstream}/stats").json()
+    print("upstream requests: " + ", ".join(f"{key} {value}" for key, value in sorted(upstream.items())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import argparse
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+
+import flask
+
+app = flask.Flask(__name__)
+
+settings = {"latency": 0.2, "matches": 30}
+request_counter = Counter()
+request_counter_lock = threading.Lock()
+sessions = set()
+
+roles = ["SR", "SRA1", "SRA2"]
+icons = ["Ansetzung bestätigt.", "Ansetzung nicht bestätigt.", "Vorläufige Einteilung"]
+teams = ["FC Musterstadt", "SV Beispielhausen", "TSV Testdorf", "SpVgg Probe", "VfB Attrappe", "SC Platzhalter"]
+
+
+@app.before_request
+def simulate_upstream():
+    if flask.request.endpoint in ("stats", "reset_stats"):
+        return
+    with request_counter_lock:
+        request_counter[flask.request.endpoint] += 1
+    time.sleep(settings["latency"])
+
+
+def page(body):
+    return f"<html><body>{body}</body></html>"
+
+
+@app.route("/spielplus/login.do")
+def landing():
+    return page("DFBnet stand-in")
+
+
+@app.route("/spielplus/oauth/login")
+def login_form():
+    action = flask.url_for("login", _external=True)
+    return page(f'<form id="kc-form-login" action="{action}" method="post">'
+                f'<input name="username"><input name="password" type="password"></form>')
+
+
+@app.route("/auth/login", methods=["POST"])
+def login():
+    session_id = uuid.uuid4().hex
+    sessions.add(session_id)
+    response = flask.make_response(page('<a href="/sria/start.do">Schiriansetzung</a>'))
+    response.set_cookie("JSESSIONID", session_id)
+    return response
+
+
+@app.route("/sria/start.do")
+def start():
+    return page('<a href="/sria/mod_sria/ansetzung.do">Ansetzung</a>')
+
+
+@app.route("/sria/mod_sria/ansetzung.do")
+def ansetzung():
+    return page("Ansetzung")
+
+
+def match_row(rng, day, ref_name):
+    kickoff = day.replace(hour=rng.choice([11, 13, 15, 18]), minute=rng.choice([0, 30]))
+    home, guest = rng.sample(teams, 2)
+    names = [ref_name] + [f"Assistent {rng.randint(1, 99)}" for _ in roles[1:]]
+    team = "".join(f"<tr><td>{role}</td><td>{name}</td><td><img alt=\"{rng.choice(icons)}\"></td></tr>"
+                   for role, name in zip(roles, names))
+    return (f"<tr><td></td><td>{kickoff.strftime('%a')}<br>{kickoff.strftime('%d.%m.%Y')}<br>"
+            f"{kickoff.strftime('%H:%M')}</td><td>Kreisliga {rng.choice('ABC')}<br>{rng.randint(100000, 999999)}"
+            f"</td><td></td><td>{home}<br>Sportplatz {home}</td><td>{guest}</td><td></td>"
+            f"<td><table>{team}</table></td><td></td></tr>")
+
+
+@app.route("/sria/mod_sria/offenespielelist.do", methods=["POST"])
+def offene_spiele():
+    if flask.request.cookies.get("JSESSIONID") not in sessions:
+        return page("Bitte melden Sie sich an.")
+    form = flask.request.form
+    start_date = datetime.strptime(form["date"], "%d.%m.%Y")
+    datedelta = int(form["datedelta"])
+    ref_name = f"{form['srvorname']} {form['srnachname']}"
+    # Same referee and window always produce the same matches
+    rng = random.Random(f"{ref_name}{form['date']}{datedelta}")
+    count = min(settings["matches"], datedelta + 1)
+    days = sorted(rng.sample(range(datedelta + 1), count))
+    rows = "".join(match_row(rng, start_date + timedelta(days=day), ref_name) for day in days)
+    if not rows:
+        rows = '<tr><td>Keine Einträge gefunden!</td></tr>'
+    return page(f'<table class="sportView"><tr><th>Spiele</th></tr>{rows}</table>')
+
+
+@app.route("/stats")
+def stats():
+    with request_counter_lock:
+        return flask.jsonify(dict(request_counter))
+
+
+@app.route("/stats/reset", methods=["POST"])
+def reset_stats():
+    with request_counter_lock:
+        request_counter.clear()
+    return flask.jsonify({})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local DFBnet stand-in for load tests. Point the app to it with "
+                                                 "\"base_url\": \"http://localhost:PORT\" in config[\"spielplus\"].")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=settings["latency"], help="Delay per request in seconds")
+    parser.add_argument("--matches", type=int, default=settings["matches"], help="Matches per referee search")
+    args = parser.parse_args()
+    settings["latency"] = args.latency
+    settings["matches"] = args.matches
+    app.run(port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
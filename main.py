@@ -1,16 +1,22 @@
-import argon2
+from urllib.parse import parse_qs
+
 import dash
 from argon2.exceptions import VerifyMismatchError, VerificationError, InvalidHashError
 from dash import Dash, dcc
 import dash_bootstrap_components as dbc
 import flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from dash_auth import BasicAuth, list_groups
 
-from src.utils import config, get_password_hash_for_user, hasher, \
-    set_password_hash_for_user, url_builder, get_grouped_users, get_single_users, title
+from src.utils import config, get_password_hash_for_user, hasher, hash_password, HasherBusyError, \
+    set_password_hash_for_user, url_builder, get_grouped_users, get_single_users, title, validate_refs, refs_etag, \
+    parse_windows
 
 server = flask.Flask(__name__)  # define flask app.server
+if config.get("proxy_count", 0):
+    # Number of trusted reverse proxies in front of the app, their X-Forwarded-For sets the client address
+    server.wsgi_app = ProxyFix(server.wsgi_app, x_for=config["proxy_count"])
 dbc_css = "https://cdn.jsdelivr.net/gh/AnnMarieW/dash-bootstrap-templates/dbc.min.css"
 app = Dash(__name__, external_stylesheets=[dbc.themes.DARKLY, dbc_css], server=server, use_pages=True,
            suppress_callback_exceptions=True)
@@ -35,7 +41,7 @@ app.index_string = '''<!DOCTYPE html>
     window.addEventListener('load', ()=> {
       navigator
       .serviceWorker
-      .register('./assets/sw01.js')
+      .register('./assets/sw01.js', {scope: './'})
       .then(()=>console.log("Ready."))
       .catch(()=>console.log("Err..."));
     });
@@ -54,20 +60,24 @@ app.index_string = '''<!DOCTYPE html>
 # You can also use a function to get user groups
 def check_user(username, password):
     hash_ = get_password_hash_for_user(username)
-    result = True
     try:
         # Verify password, raises exception if wrong.
+        # BasicAuth calls this on every request, so it stays in the request thread and never fails fast.
         hasher.verify(hash_, password)
-    except VerifyMismatchError or VerificationError or InvalidHashError:
-        result = False
+    except (VerifyMismatchError, VerificationError, InvalidHashError):
+        return False
 
     # Now that we have the cleartext password,
     # check the hash's parameters and if outdated,
     # rehash the user's password in the database.
     if hasher.check_needs_rehash(hash_):
-        set_password_hash_for_user(username, hasher.hash(password))
+        try:
+            set_password_hash_for_user(username, hash_password(password))
+        except HasherBusyError:
+            # Rehash on one of the next logins
+            pass
 
-    return result
+    return True
 
 
 def get_user_groups(user):
@@ -87,6 +97,55 @@ BasicAuth(app, auth_func=check_user, user_groups=get_user_groups,
                                                           "/assets/images/<name>"])
 
 
+def get_callback_refs(payload):
+    values = {}
+    for el in payload.get("inputs", []) + payload.get("state", []):
+        if isinstance(el, dict) and isinstance(el.get("id"), str):
+            values[f"{el['id']}.{el['property']}"] = el.get("value")
+    # Page content of /refs, rendered by the dash pages routing callback
+    if (values.get("_pages_location.pathname") or "").endswith("/refs"):
+        query = parse_qs((values.get("_pages_location.search") or "").lstrip("?"))
+        return [ref.split("_") for ref in query.get("refs", [])], parse_windows(query.get("windows", [None])[-1])
+    # Row data of the single grid mode, the download callbacks share the states but never get an ETag
+    if "match-grid" in payload.get("output", "") and "grid-refs.data" in values:
+        return values["grid-refs.data"], parse_windows(values.get("grid-windows.data"))
+    return None, 1
+
+
+@server.before_request
+def conditional_refs_response():
+    if not flask.request.path.endswith("/_dash-update-component") or list_groups() is None:
+        return None
+    payload = flask.request.get_json(silent=True) or {}
+    refs, windows = get_callback_refs(payload)
+    if not refs:
+        return None
+    valid_refs = validate_refs(refs)
+    if not valid_refs:
+        return None
+    # In single grid mode the page layout holds no matches, only the match-grid rows depend on them
+    with_matches = not config.get("single_grid", False) or "match-grid" in payload.get("output", "")
+    # The request body is part of the tag, the service worker caches the response per body
+    etag = refs_etag(valid_refs, flask.request.get_data(), windows, with_matches=with_matches)
+    flask.g.refs_etag = etag
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+@server.after_request
+def set_refs_etag(response):
+    if "refs_etag" in flask.g and response.status_code == 200:
+        response.set_etag(flask.g.refs_etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+    if flask.request.path.endswith("/assets/sw01.js"):
+        # Let the service worker control the whole app and not only /assets/
+        response.headers["Service-Worker-Allowed"] = "/"
+    return response
+
+
 def layout():
     user_groups = list_groups()
     if user_groups is None:
@@ -1,13 +1,40 @@
+import threading
+import time
+from collections import defaultdict, deque
+
 import dash
 import dash_bootstrap_components as dbc
+import flask
 from dash import html, callback, Input, Output, State
 from dash_auth import public_callback
 
-from src.utils import hasher
+from src.utils import config, hash_password, HasherBusyError
 
 
 dash.register_page(__name__)
 
+# Hashes per client and minute. The counters are kept per gunicorn worker, so a client may get up to
+# workers * hash_rate_limit hashes. Behind a reverse proxy set "proxy_count" in config.json, otherwise
+# all clients share the address of the proxy.
+rate_limit = config.get("hash_rate_limit", 5)
+client_requests = defaultdict(deque)
+client_requests_lock = threading.Lock()
+
+
+def is_rate_limited(client):
+    now = time.monotonic()
+    with client_requests_lock:
+        if len(client_requests) > 1000:
+            for key in [key for key, value in client_requests.items() if not value or value[-1] < now - 60]:
+                del client_requests[key]
+        timestamps = client_requests[client]
+        while timestamps and timestamps[0] < now - 60:
+            timestamps.popleft()
+        if len(timestamps) >= rate_limit:
+            return True
+        timestamps.append(now)
+        return False
+
 
 def layout():
     password_input = html.Div(
@@ -42,4 +69,9 @@ def layout():
 def generate_hash(_, _1, password):
     if not password:
         return ""
-    return hasher.hash(password)
+    if is_rate_limited(flask.request.remote_addr):
+        return "Zu viele Anfragen, bitte versuche es in einer Minute erneut."
+    try:
+        return hash_password(password, public=True)
+    except HasherBusyError:
+        return "Der Server ist gerade ausgelastet, bitte versuche es gleich erneut."
@@ -1,76 +1,80 @@
-import glob
 import io
 import os.path
-import subprocess
 import tempfile
 from collections import defaultdict
-from datetime import datetime, timedelta, date
+from datetime import date, timedelta
 from typing import Dict, List, Tuple
 from zipfile import ZipFile
 
 import dash
-from dash import html, Output, Input, dcc, State, ALL
-from dash_auth import protected_callback, list_groups
+from dash import html, Output, Input, dcc, State, ALL, MATCH
+from dash_auth import protected_callback
 import dash_bootstrap_components as dbc
 
-from src.utils import prepare_search_session, search_ref, Match, config, get_grouped_users, get_single_users, title, \
-    template, create_instagram_template, pdf_convert, jpg_convert
+from src.utils import Match, config, title, template, create_instagram_template, pdf_convert, jpg_convert, \
+    get_matches_parallel, validate_refs, create_pdf, create_jpg, parse_windows, get_window_start, url_builder, \
+    max_windows
 import dash_ag_grid as dag
-import pandas as pd
 
 dash.register_page(__name__, title=title)
 
-session = None
-modified_timestamp = -1
+single_grid = config.get("single_grid", False)
 
 
-def create_ag_grids(data: Dict[Tuple[str, str] | date, List[Match]], id, hidden):
-    def list_to_grid(data: List[Match], hide_date: bool):
-        if not hide_date:
-            columnDefs = [
-                {"field": "Datum", "width": 120, "suppressSizeToFit": True}
-            ]
-        else:
-            columnDefs = []
-
-        columnDefs += [
-            {"field": "Zeit", "width": 80, "suppressSizeToFit": True},
-            {"field": "Staffel", "width": 100, "suppressSizeToFit": True},
-            {"field": "Heim"},
-            {"field": "Gast"},
-            {"field": "SR-Team", "wrapText": True, "autoHeight": True,
-             "cellStyle": {"wordBreak": "normal", "whiteSpace": "pre"}},
-            {"field": "Ort", "wrapText": True, "cellStyle": {"wordBreak": "normal", "whiteSpace": "pre"}},
+def group_matches(valid_refs: List[List[str]], windows: int):
+    name_matches = {}
+    for ref, matches in zip(valid_refs, get_matches_parallel(valid_refs, windows)):
+        name_matches[tuple(ref)] = matches
+
+    date_matches = defaultdict(list)
+    for m in name_matches.values():
+        for a in m:
+            if a in date_matches[a.date.date()]:
+                continue
+            date_matches[a.date.date()] += [a]
+    return name_matches, dict(date_matches)
+
+
+def column_defs(hide_date: bool):
+    if not hide_date:
+        columnDefs = [
+            {"field": "Datum", "width": 120, "suppressSizeToFit": True}
         ]
+    else:
+        columnDefs = []
 
-        df = pd.DataFrame(columns=[x["field"] for x in columnDefs])
+    columnDefs += [
+        {"field": "Zeit", "width": 80, "suppressSizeToFit": True},
+        {"field": "Staffel", "width": 100, "suppressSizeToFit": True},
+        {"field": "Heim"},
+        {"field": "Gast"},
+        {"field": "SR-Team", "wrapText": True, "autoHeight": True,
+         "cellStyle": {"wordBreak": "normal", "whiteSpace": "pre"}},
+        {"field": "Ort", "wrapText": True, "cellStyle": {"wordBreak": "normal", "whiteSpace": "pre"}},
+    ]
+    return columnDefs
 
-        for i, el in enumerate(data):
-            new_row = []
-            if not hide_date:
-                new_row += [el.date.strftime("%a, %d.%m")]
-            ref_team = ""
-            for t in el.team:
-                ref_team += t.role
-                if t.name:
-                    ref_team += f": {t.name} ({t.state})"
-                if t.atspl:
-                    ref_team += f" [{t.atspl}]"
-                ref_team += "\n"
 
-            new_row += [el.date.strftime("%H:%M"), el.staffel, el.home, el.guest, ref_team, el.location]
-            df.loc[i] = new_row
+def match_to_row(el: Match, hide_date: bool):
+    row = {}
+    if not hide_date:
+        row["Datum"] = el.date.strftime("%a, %d.%m")
+    ref_team = ""
+    for t in el.team:
+        ref_team += t.role
+        if t.name:
+            ref_team += f": {t.name} ({t.state})"
+        if t.atspl:
+            ref_team += f" [{t.atspl}]"
+        ref_team += "\n"
 
-        return html.Div(dag.AgGrid(
-            rowData=df.to_dict("records"),
-            columnDefs=columnDefs,
-            dashGridOptions={"domLayout": "autoHeight", "enableCellTextSelection": True, "ensureDomOrder": True},
-            columnSize="responsiveSizeToFit",
-        ), className="dbc dbc-ag-grid")
+    row.update({"Zeit": el.date.strftime("%H:%M"), "Staffel": el.staffel, "Heim": el.home, "Gast": el.guest,
+                "SR-Team": ref_team, "Ort": el.location})
+    return row
 
-    content = []
-    download_data = []
-    for index, key in enumerate(sorted(data)):
+
+def iterate_groups(data: Dict[Tuple[str, str] | date, List[Match]]):
+    for key in sorted(data):
         current_data = data[key]
         if isinstance(key, date):
             title = key.strftime("%a, %d.%m.%Y")
@@ -81,25 +85,42 @@ def create_ag_grids(data: Dict[Tuple[str, str] | date, List[Match]], id, hidden)
             hide_date = False
         else:
             raise ValueError(f"Unexpected key type: {type(key)}")
+        yield title, hide_date, current_data
+
+
+def create_download_button(index, label="Download", **kwargs):
+    if pdf_convert:
+        dropdown_download = dbc.DropdownMenu(
+            [
+                dbc.DropdownMenuItem(".PPTX", id={"type": "download-instagram-button", "index": index}),
+                dbc.DropdownMenuItem(".PDF", id={"type": "download-instagram-button-pdf", "index": index}),
+            ],
+            label=label, color="primary", **kwargs)
+        if jpg_convert:
+            dropdown_download.children += [
+                dbc.DropdownMenuItem(".JPG", id={"type": "download-instagram-button-jpg", "index": index}),
+            ]
+        return dropdown_download
+    return dbc.Button(label, id={"type": "download-instagram-button", "index": index},
+                      outline=True, color="primary", **kwargs)
+
+
+def create_ag_grids(data: Dict[Tuple[str, str] | date, List[Match]], id, hidden):
+    def list_to_grid(data: List[Match], hide_date: bool):
+        return html.Div(dag.AgGrid(
+            rowData=[match_to_row(el, hide_date) for el in data],
+            columnDefs=column_defs(hide_date),
+            dashGridOptions={"domLayout": "autoHeight", "enableCellTextSelection": True, "ensureDomOrder": True},
+            columnSize="responsiveSizeToFit",
+        ), className="dbc dbc-ag-grid")
+
+    content = []
+    download_data = []
+    for index, (heading, hide_date, current_data) in enumerate(iterate_groups(data)):
         content.append(html.Br())
-        heading = html.H3(title)
-        heading_div = html.Div([heading], style={"display": "flex", "align-items": "center"})
+        heading_div = html.Div([html.H3(heading)], style={"display": "flex", "align-items": "center"})
         if template:
-            if pdf_convert:
-                dropdown_download = dbc.DropdownMenu(
-                    [
-                        dbc.DropdownMenuItem(".PPTX", id={"type": "download-instagram-button", "index": index}),
-                        dbc.DropdownMenuItem(".PDF", id={"type": "download-instagram-button-pdf", "index": index}),
-                    ],
-                    label="Download", color="primary", style={"margin-left": "auto"})
-                if jpg_convert:
-                    dropdown_download.children += [dbc.DropdownMenuItem(".JPG", id={"type": "download-instagram-button-jpg", "index": index}),
-]
-                heading_div.children += [dropdown_download]
-            else:
-                button_download = dbc.Button("Download", id={"type": "download-instagram-button", "index": index},
-                                             outline=True, color="primary", style={"margin-left": "auto"})
-                heading_div.children += [button_download]
+            heading_div.children += [create_download_button(index, style={"margin-left": "auto"})]
             download_data.append([x.create_powerpoint_output() for x in current_data])
         else:
             # Template config is not valid
@@ -109,7 +130,47 @@ def create_ag_grids(data: Dict[Tuple[str, str] | date, List[Match]], id, hidden)
     return html.Div(content, id=id, hidden=hidden), download_data
 
 
-def layout(refs=None):
+def grid_rows(data: Dict[Tuple[str, str] | date, List[Match]]):
+    rows = []
+    for heading, hide_date, current_data in iterate_groups(data):
+        rows += [{"Gruppe": heading, **match_to_row(el, hide_date)} for el in current_data]
+    return rows
+
+
+def create_single_grid(view, id, hidden):
+    # One virtualised grid per view, rows are fetched block-wise by load_grid_rows
+    columnDefs = [{"field": "Gruppe", "pinned": "left", "width": 180, "suppressSizeToFit": True}]
+    for column in column_defs(hide_date=view == "date"):
+        if column["field"] == "SR-Team":
+            # Infinite row model needs fixed row heights, show the full team as tooltip
+            column.pop("autoHeight")
+            column["tooltipField"] = "SR-Team"
+        columnDefs.append(column)
+
+    content = [html.Br()]
+    if template:
+        # Slides are built on the server for the group of the selected row, see get_download_data
+        content.append(html.Div([
+            html.Span("Zeile auswählen, um ihre Gruppe herunterzuladen.", className="me-3"),
+            create_download_button(view, style={"margin-left": "auto"}),
+        ], style={"display": "flex", "align-items": "center"}))
+        content.append(html.Br())
+
+    content.append(html.Div(dag.AgGrid(
+        id={"type": "match-grid", "view": view},
+        columnDefs=columnDefs,
+        rowModelType="infinite",
+        dashGridOptions={"rowHeight": 100, "rowBuffer": 0, "cacheBlockSize": 50, "maxBlocksInCache": 10,
+                         "infiniteInitialRowCount": 50, "enableCellTextSelection": True,
+                         "tooltipShowDelay": 0, "rowSelection": "single"},
+        defaultColDef={"sortable": False},
+        columnSize="responsiveSizeToFit",
+        style={"height": "75vh"},
+    ), className="dbc dbc-ag-grid"))
+    return html.Div(content, id=id, hidden=hidden), []
+
+
+def layout(refs=None, windows=None):
     empty_placeholder = html.Div([
             html.Br(),
             html.H1("No referee selected..."),
@@ -120,51 +181,57 @@ def layout(refs=None):
         return empty_placeholder
     if isinstance(refs, str):
         refs = [refs]
-    refs_temp = [ref.split("_") for ref in refs]
-    valid_refs = []
-    user_groups = list_groups()
-    ref_whitelist = []
-    if "admin" in user_groups:
-        valid_refs = refs_temp
-    else:
-        for value in get_grouped_users(user_groups).values():
-            ref_whitelist += value
-        ref_whitelist += get_single_users(user_groups)
-        for ref in refs_temp:
-            if ref in ref_whitelist:
-                valid_refs += [ref]
-        if len(valid_refs) == 0:
-            return empty_placeholder
-    global session, modified_timestamp
-    if session is None or modified_timestamp < datetime.now() - timedelta(minutes=15):
-        session = prepare_search_session(username=config["spielplus"]["username"],
-                                         password=config["spielplus"]["password"])
-        modified_timestamp = datetime.now()
+    valid_refs = validate_refs([ref.split("_") for ref in refs])
+    if len(valid_refs) == 0:
+        return empty_placeholder
 
-    name_matches = {}
-    for ref in valid_refs:
-        name_matches[tuple(ref)] = search_ref(session, *ref)
+    windows = parse_windows(windows)
 
-    date_matches = defaultdict(list)
-    for m in name_matches.values():
-        for a in m:
-            if a in date_matches[a.date.date()]:
-                continue
-            date_matches[a.date.date()] += [a]
-    date_matches = dict(date_matches)
+    if single_grid:
+        div_names, data_names = create_single_grid("name", id="tables-name", hidden=True)
+        div_dates, data_dates = create_single_grid("date", id="tables-date", hidden=True)
+    else:
+        name_matches, date_matches = group_matches(valid_refs, windows)
+        div_names, data_names = create_ag_grids(name_matches, id="tables-name", hidden=True)
+        div_dates, data_dates = create_ag_grids(date_matches, id="tables-date", hidden=True)
 
-    div_names, data_names = create_ag_grids(name_matches, id="tables-name", hidden=True)
-    div_dates, data_dates = create_ag_grids(date_matches, id="tables-date", hidden=True)
+    end = get_window_start(windows) - timedelta(days=1)
+    load_more = html.Div([
+        html.Span(f"Spiele bis {end.strftime('%d.%m.%Y')}", className="me-3"),
+        dbc.Button("Mehr laden", href="/refs" + url_builder(valid_refs) + f"&windows={windows + 1}",
+                   outline=True, color="primary", disabled=windows >= max_windows),
+    ], style={"display": "flex", "align-items": "center"})
 
     return html.Div([
         dcc.Download(id="download-instagram-template"),
         dcc.Store(id="download-instagram-data", data=[data_names, data_dates]),
+        dcc.Store(id="grid-refs", data=valid_refs),
+        dcc.Store(id="grid-windows", data=windows),
         div_names,
         div_dates,
+        html.Br(),
+        load_more,
         html.Br()
     ])
 
 
+@protected_callback(
+    Output({"type": "match-grid", "view": MATCH}, "getRowsResponse"),
+    Input({"type": "match-grid", "view": MATCH}, "getRowsRequest"),
+    State("grid-refs", "data"),
+    State("grid-windows", "data"),
+)
+def load_grid_rows(request, refs, windows):
+    if request is None or not refs:
+        return dash.no_update
+    name_matches, date_matches = group_matches(validate_refs(refs), parse_windows(windows))
+    if dash.ctx.triggered_id["view"] == "name":
+        rows = grid_rows(name_matches)
+    else:
+        rows = grid_rows(date_matches)
+    return {"rowData": rows[request["startRow"]:request["endRow"]], "rowCount": len(rows)}
+
+
 @protected_callback(
     Output("tables-name", "hidden"),
     Output("tables-date", "hidden"),
@@ -174,62 +241,87 @@ def toggle_mode(value):
     return value, not value
 
 
-@protected_callback(
-    Output("download-instagram-template", "data", allow_duplicate=True),
+def get_download_data(data, index_data, refs, windows):
+    clicked_idx = dash.ctx.triggered_id["index"]
+    if isinstance(clicked_idx, int):
+        return data[index_data][clicked_idx]
+
+    # Single grid mode, the button index is the view and the slides are built from the selected row
+    selected_rows = {}
+    for state in dash.ctx.states_list:
+        if isinstance(state, list):
+            selected_rows.update({x["id"]["view"]: x.get("value") for x in state})
+    if not selected_rows.get(clicked_idx) or not refs:
+        return None
+    group = selected_rows[clicked_idx][0]["Gruppe"]
+    name_matches, date_matches = group_matches(validate_refs(refs), parse_windows(windows))
+    for heading, _, current_data in iterate_groups(name_matches if clicked_idx == "name" else date_matches):
+        if heading == group:
+            return [x.create_powerpoint_output() for x in current_data]
+    return None
+
+
+download_states = [
     State("download-instagram-data", "data"),
     State("tables-name", "hidden"),
+    State("grid-refs", "data"),
+    State("grid-windows", "data"),
+    State({"type": "match-grid", "view": ALL}, "selectedRows"),
+]
+
+
+@protected_callback(
+    Output("download-instagram-template", "data", allow_duplicate=True),
+    *download_states,
     Input({"type": "download-instagram-button", "index": ALL}, "n_clicks"),
     prevent_initial_call=True
 )
-def download_instagram_template(data, index_data, _):
+def download_instagram_template(data, index_data, refs, windows, _, _1):
     if not dash.ctx.triggered_id:
         return dash.no_update
-    clicked_idx = dash.ctx.triggered_id["index"]
+    download_data = get_download_data(data, index_data, refs, windows)
+    if not download_data:
+        return dash.no_update
     data_buffer = io.BytesIO()
-    create_instagram_template(data[index_data][clicked_idx], data_buffer)
+    create_instagram_template(download_data, data_buffer)
     return dcc.send_bytes(data_buffer.getvalue(), "matchday.pptx")
 
 
-def create_pdf(data, dir_):
-    pptx_file = os.path.join(dir_, "matchday.pptx")
-    print(dir_)
-    data_buffer = io.FileIO(pptx_file, "x")
-    create_instagram_template(data, data_buffer)
-    subprocess.run(["libreoffice", "--convert-to", "pdf", "matchday.pptx"], cwd=dir_)
-
-
 @protected_callback(
     Output("download-instagram-template", "data", allow_duplicate=True),
-    State("download-instagram-data", "data"),
-    State("tables-name", "hidden"),
+    *download_states,
     Input({"type": "download-instagram-button-pdf", "index": ALL}, "n_clicks"),
     prevent_initial_call=True
 )
-def download_instagram_template_pdf(data, index_data, _):
+def download_instagram_template_pdf(data, index_data, refs, windows, _, _1):
     if not dash.ctx.triggered_id:
         return dash.no_update
-    clicked_idx = dash.ctx.triggered_id["index"]
+    download_data = get_download_data(data, index_data, refs, windows)
+    if not download_data:
+        return dash.no_update
     with tempfile.TemporaryDirectory() as dir_:
-        create_pdf(data[index_data][clicked_idx], dir_)
+        # Threaded workers convert concurrently, each LibreOffice needs its own profile
+        create_pdf(download_data, dir_, profile_dir=os.path.join(dir_, "lo-profile"))
         return dcc.send_file(os.path.join(dir_, "matchday.pdf"), "matchday.pdf")
 
 
 @protected_callback(
     Output("download-instagram-template", "data", allow_duplicate=True),
-    State("download-instagram-data", "data"),
-    State("tables-name", "hidden"),
+    *download_states,
     Input({"type": "download-instagram-button-jpg", "index": ALL}, "n_clicks"),
     prevent_initial_call=True
 )
-def download_instagram_template_jpg(data, index_data, _):
+def download_instagram_template_jpg(data, index_data, refs, windows, _, _1):
     if not dash.ctx.triggered_id:
         return dash.no_update
-    clicked_idx = dash.ctx.triggered_id["index"]
+    download_data = get_download_data(data, index_data, refs, windows)
+    if not download_data:
+        return dash.no_update
     with tempfile.TemporaryDirectory() as dir_:
-        create_pdf(data[index_data][clicked_idx], dir_)
-        subprocess.run(["pdftoppm", "-jpeg", "matchday.pdf", "matchday"], cwd=dir_)
+        # Threaded workers convert concurrently, each LibreOffice needs its own profile
+        create_pdf(download_data, dir_, profile_dir=os.path.join(dir_, "lo-profile"))
         with ZipFile(os.path.join(dir_, 'matchday.zip'), 'w') as myzip:
-            for file in glob.glob(os.path.join(dir_, "matchday-*.jpg")):
+            for file in create_jpg(dir_):
                 path, name = os.path.split(file)
                 myzip.write(file, name)
         return dcc.send_file(os.path.join(dir_, "matchday.zip"), "matchday.zip")
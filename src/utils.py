@@ -1,17 +1,30 @@
+import contextlib
+import glob
+import hashlib
 import io
 import json
 import logging
+import multiprocessing
 import os.path
 import shutil
-from datetime import datetime
+import subprocess
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 from typing import List
 from urllib.parse import urljoin
 
 import dash
+import dash_ag_grid as dag
 import requests
+from requests.adapters import HTTPAdapter
 from argon2 import PasswordHasher
 from bs4 import BeautifulSoup
 from dash import dcc
+from dash_auth import list_groups
+from PIL import Image, ImageOps
 from pptx import Presentation
 from pptx.shapes.placeholder import PicturePlaceholder, SlidePlaceholder
 
@@ -73,6 +86,48 @@ pdf_convert = shutil.which("libreoffice") is not None
 jpg_convert = shutil.which("pdftoppm") is not None
 
 
+hash_pool = None
+hash_pool_lock = threading.Lock()
+hash_workers = config.get("hash_workers", 2)
+# By default every request thread of a gunicorn worker (gunicorn.conf.py) may queue one hash
+hash_slots = threading.BoundedSemaphore(config.get("hash_queue_size", int(os.environ.get("GUNICORN_THREADS", 16))))
+# Anonymous hashing may never occupy all workers, rehashes keep at least one
+public_hash_slots = threading.BoundedSemaphore(max(1, hash_workers - 1))
+
+
+class HasherBusyError(Exception):
+    pass
+
+
+def get_hash_pool():
+    global hash_pool
+    with hash_pool_lock:
+        if hash_pool is None:
+            # The gunicorn worker already runs threads, fork() from a threaded process can deadlock the child
+            hash_pool = ProcessPoolExecutor(max_workers=hash_workers,
+                                            mp_context=multiprocessing.get_context("forkserver"))
+    return hash_pool
+
+
+def _hash_password(password):
+    return hasher.hash(password)
+
+
+def run_hasher(func, *args, public=False):
+    # Reject right away if the queue is full instead of blocking the request worker
+    slots = public_hash_slots if public else hash_slots
+    if not slots.acquire(blocking=False):
+        raise HasherBusyError()
+    try:
+        return get_hash_pool().submit(func, *args).result()
+    finally:
+        slots.release()
+
+
+def hash_password(password, public=False):
+    return run_hasher(_hash_password, password, public=public)
+
+
 def update_config():
     with open("config.json", "w") as f:
         json.dump(config, f)
@@ -96,10 +151,11 @@ def url_builder(users: List[List[str]], prefix="refs") -> str:
     return args
 
 
-base_url = "https://www.dfbnet.org"
-dfbnet_landing = "https://www.dfbnet.org/spielplus/login.do"
-dfbnet_login = "https://www.dfbnet.org/spielplus/oauth/login"
-search = "https://www.dfbnet.org/sria/mod_sria/offenespielelist.do?reqCode=view"
+base_url = config["spielplus"].get("base_url", "https://www.dfbnet.org")
+dfbnet_landing = urljoin(base_url, "/spielplus/login.do")
+dfbnet_login = urljoin(base_url, "/spielplus/oauth/login")
+search = urljoin(base_url, "/sria/mod_sria/offenespielelist.do?reqCode=view")
+dfbnet_connections = config["spielplus"].get("connections", 8)
 
 
 def get_grouped_users(user_groups):
@@ -120,8 +176,10 @@ def get_single_users(user_groups):
     return single_user_links
 
 
-def get_ref_req(vorname, nachname, datedelta):
-    return {"staffel": "", "msa_id": "0", "status": "4", "date": datetime.today().strftime("%d.%m.%Y"),
+def get_ref_req(vorname, nachname, datedelta, start=None):
+    if start is None:
+        start = datetime.today()
+    return {"staffel": "", "msa_id": "0", "status": "4", "date": start.strftime("%d.%m.%Y"),
             "datedelta": str(datedelta), "srvorname": vorname, "srnachname": nachname, "spieltag": ""}
 
 
@@ -311,6 +369,10 @@ def parse_matches(web_page):
 
 def prepare_search_session(username, password):
     s = requests.Session()
+    # The session is shared by all threads of the worker, keep enough connections to DFBnet open
+    adapter = HTTPAdapter(pool_maxsize=dfbnet_connections)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
     s.get(dfbnet_landing)
     resp = s.get(dfbnet_login)
     x = BeautifulSoup(resp.text, "html.parser")
@@ -329,12 +391,223 @@ def prepare_search_session(username, password):
     return s
 
 
-def search_ref(session, nachname, vorname):
-    resp = session.post(search, data=get_ref_req(nachname=nachname, vorname=vorname, datedelta=999))
+class DFBnetError(Exception):
+    pass
+
+
+def search_ref(session, nachname, vorname, start=None, datedelta=999):
+    resp = session.post(search, data=get_ref_req(nachname=nachname, vorname=vorname, datedelta=datedelta,
+                                                 start=start))
+    resp.raise_for_status()
     x = BeautifulSoup(resp.text, "html.parser")
+    # Without the result table the answer is no search result, e.g. the login page of an expired session
+    if x.find("table", attrs={"class": "sportView"}) is None:
+        raise DFBnetError(f"No search result for '{vorname} {nachname}'")
     return parse_matches(x)
 
 
+session = None
+session_lock = threading.Lock()
+modified_timestamp = -1
+match_cache = {}  # (nachname, vorname, window start): (timestamp, matches, version)
+match_cache_locks = defaultdict(threading.Lock)
+match_cache_locks_lock = threading.Lock()
+match_cache_timeout = timedelta(minutes=5)
+date_window = timedelta(days=config.get("date_window", 21))
+max_windows = 52
+config_version = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def get_code_version() -> str:
+    # A deploy changing the layouts must not be answered with 304 for the same matches
+    app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    version = hashlib.sha1(f"{dash.__version__}/{dag.__version__}".encode())
+    for pattern in ("*.py", os.path.join("pages", "*.py"), os.path.join("src", "*.py")):
+        for path in sorted(glob.glob(os.path.join(app_dir, pattern))):
+            with open(path, "rb") as f:
+                version.update(f.read())
+    return version.hexdigest()
+
+
+code_version = get_code_version()
+dfbnet_pool = ThreadPoolExecutor(max_workers=dfbnet_connections)
+
+
+def get_session():
+    global session, modified_timestamp
+    with session_lock:
+        if session is None or modified_timestamp < datetime.now() - timedelta(minutes=15):
+            session = prepare_search_session(username=config["spielplus"]["username"],
+                                             password=config["spielplus"]["password"])
+            modified_timestamp = datetime.now()
+        return session
+
+
+def reset_session():
+    global session
+    with session_lock:
+        session = None
+
+
+def search_ref_relogin(ref: List[str], start: date, datedelta: int) -> List[Match]:
+    try:
+        return search_ref(get_session(), *ref, start=start, datedelta=datedelta)
+    except DFBnetError:
+        # The DFBnet login may expire before the session is renewed, log in again once
+        reset_session()
+        return search_ref(get_session(), *ref, start=start, datedelta=datedelta)
+
+
+def matches_version(matches: List[Match]) -> str:
+    content = [(repr(m), m.match_id, [t.atspl for t in m.team]) for m in matches]
+    return hashlib.sha1(repr(content).encode()).hexdigest()
+
+
+def parse_windows(windows) -> int:
+    try:
+        return min(max(int(windows), 1), max_windows)
+    except (TypeError, ValueError):
+        return 1
+
+
+def get_window_start(window: int) -> date:
+    return date.today() + window * date_window
+
+
+def get_cached_ref_windows(ref: List[str], windows: int):
+    keys = [(*ref, get_window_start(window)) for window in range(windows)]
+    with match_cache_locks_lock:
+        locks = [match_cache_locks[key] for key in keys]
+    # Concurrent viewers of the same referee wait for a single request to DFBnet,
+    # locks are always taken in window order
+    with contextlib.ExitStack() as stack:
+        for lock in locks:
+            stack.enter_context(lock)
+        expired = datetime.now() - match_cache_timeout
+        cached_windows = {}
+        missing = []
+        for window, key in enumerate(keys):
+            if key in match_cache and match_cache[key][0] > expired:
+                cached_windows[window] = match_cache[key]
+            else:
+                missing.append(window)
+
+        # Adjacent uncached windows are fetched with a single search and split into their cache entries
+        spans = []
+        for window in missing:
+            if spans and spans[-1][-1] == window - 1:
+                spans[-1].append(window)
+            else:
+                spans.append([window])
+        for span in spans:
+            # Failed searches raise and are never stored in the cache
+            matches = search_ref_relogin(ref, start=get_window_start(span[0]),
+                                         datedelta=len(span) * date_window.days - 1)
+            for window in span:
+                start = get_window_start(window)
+                window_matches = [m for m in matches if start <= m.date.date() < start + date_window]
+                cached_windows[window] = (datetime.now(), window_matches, matches_version(window_matches))
+                match_cache[keys[window]] = cached_windows[window]
+        return [cached_windows[window] for window in range(windows)]
+
+
+def prune_match_cache():
+    # Drop expired entries and their locks, e.g. windows starting on a past day
+    with match_cache_locks_lock:
+        expired = datetime.now() - match_cache_timeout
+        for key, value in list(match_cache.items()):
+            if value[0] <= expired:
+                match_cache.pop(key, None)
+        for key, lock in list(match_cache_locks.items()):
+            if key not in match_cache and not lock.locked():
+                del match_cache_locks[key]
+
+
+def get_cached_windows(refs: List[List[str]], windows: int = 1):
+    prune_match_cache()
+    # Each window is cached separately, loading more only fetches the new window.
+    # One task per referee, so a single view queues at most len(refs) searches on the shared pool.
+    return list(dfbnet_pool.map(lambda ref: get_cached_ref_windows(ref, windows), refs))
+
+
+def get_matches_parallel(refs: List[List[str]], windows: int = 1) -> List[List[Match]]:
+    return [[m for x in cached_windows for m in x[1]] for cached_windows in get_cached_windows(refs, windows)]
+
+
+def refs_etag(refs: List[List[str]], salt: bytes = b"", windows: int = 1, with_matches: bool = True) -> str:
+    etag = hashlib.sha1(config_version.encode())
+    etag.update(code_version.encode())
+    etag.update(salt)
+    etag.update(get_window_start(windows).isoformat().encode())
+    # Without matches the tag only covers refs, windows and config, e.g. for the single grid layout
+    all_cached_windows = get_cached_windows(refs, windows) if with_matches else [[] for _ in refs]
+    for ref, cached_windows in zip(refs, all_cached_windows):
+        etag.update("_".join(ref).encode())
+        for cached_matches in cached_windows:
+            etag.update(cached_matches[2].encode())
+    return etag.hexdigest()
+
+
+def validate_refs(refs_temp: List[List[str]]) -> List[List[str]]:
+    user_groups = list_groups()
+    if "admin" in user_groups:
+        return refs_temp
+    ref_whitelist = []
+    for value in get_grouped_users(user_groups).values():
+        ref_whitelist += value
+    ref_whitelist += get_single_users(user_groups)
+    return [ref for ref in refs_temp if ref in ref_whitelist]
+
+
+image_dpi = 200
+image_cache_path = os.path.join(tempfile.gettempdir(), "dfbnet-image-cache")
+
+
+def get_scaled_image(path, width, height):
+    # Scale, crop (keeping the top of the picture) and compress the image to the placeholder size once
+    image_cache = config["template"].get("image_cache_path", image_cache_path)
+    stat = os.stat(path)
+    size = (max(1, round(width.inches * image_dpi)), max(1, round(height.inches * image_dpi)))
+    key = hashlib.sha1(repr((os.path.abspath(path), stat.st_mtime_ns, stat.st_size, size)).encode()).hexdigest()
+    for ext in (".png", ".jpg"):
+        cached_path = os.path.join(image_cache, key + ext)
+        if os.path.isfile(cached_path):
+            return cached_path
+
+    try:
+        with Image.open(path) as image:
+            image = ImageOps.exif_transpose(image)
+            crop_width = min(image.width, round(image.height * size[0] / size[1]))
+            crop_height = min(image.height, round(image.width * size[1] / size[0]))
+            left = (image.width - crop_width) // 2
+            image = image.crop((left, 0, left + crop_width, crop_height))
+            if crop_width > size[0]:
+                image = image.resize(size, Image.Resampling.LANCZOS)
+
+            os.makedirs(image_cache, exist_ok=True)
+            if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+                ext, params = ".png", {"format": "PNG", "optimize": True}
+            else:
+                image = image.convert("RGB")
+                ext, params = ".jpg", {"format": "JPEG", "quality": 85, "optimize": True}
+            cached_path = os.path.join(image_cache, key + ext)
+            # Write to a temporary file first, multiple workers may scale the same image
+            fd, temp_path = tempfile.mkstemp(suffix=ext, dir=image_cache)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    image.save(f, **params)
+                # mkstemp creates the file with 0600, the cache is shared between workers
+                os.chmod(temp_path, 0o644)
+                os.replace(temp_path, cached_path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+    except OSError as e:
+        logging.error(f"Could not scale image '{path}': {e}")
+        return path
+    return cached_path
+
+
 def create_instagram_template(data, output_buffer):
     if not template:
         return dash.no_update
@@ -364,10 +637,40 @@ def create_instagram_template(data, output_buffer):
             if type(shape) == PicturePlaceholder:
                 path = os.path.join(os.curdir, config["template"]["image_path"], match[lookup_table[i]])
                 if os.path.exists(path) and os.path.isfile(path):
-                    pic = shape.insert_picture(path)
+                    pic = shape.insert_picture(get_scaled_image(path, shape.width, shape.height))
                     if pic.crop_top != 0.0:
                         pic.crop_bottom += pic.crop_top
                         pic.crop_top = 0.0
             elif type(shape) == SlidePlaceholder:
                 shape.text = match[lookup_table[i]]
     prs.save(output_buffer)
+
+
+def create_pptx(data, dir_, name="matchday"):
+    pptx_file = os.path.join(dir_, f"{name}.pptx")
+    with io.FileIO(pptx_file, "x") as data_buffer:
+        create_instagram_template(data, data_buffer)
+    return pptx_file
+
+
+def convert_pdf(dir_, name="matchday", profile_dir=None):
+    args = ["libreoffice", "--headless", "--convert-to", "pdf", f"{name}.pptx"]
+    if profile_dir is not None:
+        # Concurrent LibreOffice instances need separate user profiles
+        args.insert(1, f"-env:UserInstallation=file://{os.path.abspath(profile_dir)}")
+    subprocess.run(args, cwd=dir_, check=True)
+    pdf_file = os.path.join(dir_, f"{name}.pdf")
+    if not os.path.isfile(pdf_file):
+        # LibreOffice exits with 0 even if the conversion failed
+        raise FileNotFoundError(f"LibreOffice did not create '{pdf_file}'")
+    return pdf_file
+
+
+def create_pdf(data, dir_, name="matchday", profile_dir=None):
+    create_pptx(data, dir_, name)
+    return convert_pdf(dir_, name, profile_dir)
+
+
+def create_jpg(dir_, name="matchday"):
+    subprocess.run(["pdftoppm", "-jpeg", f"{name}.pdf", name], cwd=dir_, check=True)
+    return sorted(glob.glob(os.path.join(dir_, f"{name}-*.jpg")))